@@ -21,36 +21,21 @@
 import argparse
 import inspect
 import logging
+import os
 from typing import Tuple
 
 import torch
 from accelerate import PartialState
 from accelerate.utils import set_seed
 
-from transformers import (
-    AutoTokenizer,
-    BloomForCausalLM,
-    BloomTokenizerFast,
-    CTRLLMHeadModel,
-    CTRLTokenizer,
-    GenerationMixin,
-    GPT2LMHeadModel,
-    GPT2Tokenizer,
-    GPTJForCausalLM,
-    LlamaForCausalLM,
-    LlamaTokenizer,
-    OpenAIGPTLMHeadModel,
-    OpenAIGPTTokenizer,
-    OPTForCausalLM,
-    TransfoXLLMHeadModel,
-    TransfoXLTokenizer,
-    XLMTokenizer,
-    XLMWithLMHeadModel,
-    XLNetLMHeadModel,
-    XLNetTokenizer,
-)
+import transformers
+from transformers import BitsAndBytesConfig, GenerationMixin
 from transformers.modeling_outputs import CausalLMOutputWithPast
+from transformers.utils import is_torch_compile_available
+
 
+# The tokenizers thread pool is not fork-safe, so keep it disabled unless explicitly requested
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -61,17 +46,19 @@ logger = logging.getLogger(__name__)
 
 MAX_LENGTH = int(10000)  # Hardcoded max length to avoid infinite loop
 
+# Only the names are stored so that the modeling and tokenization modules of the selected model type are the only
+# ones imported
 MODEL_CLASSES = {
-    "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
-    "ctrl": (CTRLLMHeadModel, CTRLTokenizer),
-    "openai-gpt": (OpenAIGPTLMHeadModel, OpenAIGPTTokenizer),
-    "xlnet": (XLNetLMHeadModel, XLNetTokenizer),
-    "transfo-xl": (TransfoXLLMHeadModel, TransfoXLTokenizer),
-    "xlm": (XLMWithLMHeadModel, XLMTokenizer),
-    "gptj": (GPTJForCausalLM, AutoTokenizer),
-    "bloom": (BloomForCausalLM, BloomTokenizerFast),
-    "llama": (LlamaForCausalLM, LlamaTokenizer),
-    "opt": (OPTForCausalLM, GPT2Tokenizer),
+    "gpt2": ("GPT2LMHeadModel", "GPT2Tokenizer"),
+    "ctrl": ("CTRLLMHeadModel", "CTRLTokenizer"),
+    "openai-gpt": ("OpenAIGPTLMHeadModel", "OpenAIGPTTokenizer"),
+    "xlnet": ("XLNetLMHeadModel", "XLNetTokenizer"),
+    "transfo-xl": ("TransfoXLLMHeadModel", "TransfoXLTokenizer"),
+    "xlm": ("XLMWithLMHeadModel", "XLMTokenizer"),
+    "gptj": ("GPTJForCausalLM", "AutoTokenizer"),
+    "bloom": ("BloomForCausalLM", "BloomTokenizerFast"),
+    "llama": ("LlamaForCausalLM", "LlamaTokenizer"),
+    "opt": ("OPTForCausalLM", "GPT2Tokenizer"),
 }
 
 # Padding text to help Transformer-XL and XLNet with short prompts as proposed by Aman Rusia
@@ -99,7 +86,7 @@ def prepare_ctrl_input(args, _, tokenizer, prompt_text):
         logger.info("CTRL typically works better with lower temperatures (and lower top_k).")
 
     encoded_prompt = tokenizer.encode(prompt_text, add_special_tokens=False)
-    if not any(encoded_prompt[0] == x for x in tokenizer.control_codes.values()):
+    if encoded_prompt[0] not in set(tokenizer.control_codes.values()):
         logger.info("WARNING! You are not starting your generation from a control code so you won't get good results")
     return prompt_text
 
@@ -191,30 +178,35 @@ def sparse_model_config(model_config):
 
 def generate_past_key_values(model, batch_size, seq_len):
     num_block_layers, num_attention_heads, num_embedding_size_per_head = sparse_model_config(model.config)
+    # Allocate the keys and values of all the layers in a single buffer on the target device, and hand out views of it
     if model.config.model_type == "bloom":
+        buffer = torch.empty(
+            num_block_layers,
+            2,
+            int(num_attention_heads * batch_size),
+            num_embedding_size_per_head * seq_len,
+            dtype=model.dtype,
+            device=model.device,
+        )
         past_key_values = tuple(
             (
-                torch.empty(int(num_attention_heads * batch_size), num_embedding_size_per_head, seq_len)
-                .to(model.dtype)
-                .to(model.device),
-                torch.empty(int(num_attention_heads * batch_size), seq_len, num_embedding_size_per_head)
-                .to(model.dtype)
-                .to(model.device),
+                buffer[layer, 0].view(int(num_attention_heads * batch_size), num_embedding_size_per_head, seq_len),
+                buffer[layer, 1].view(int(num_attention_heads * batch_size), seq_len, num_embedding_size_per_head),
             )
-            for _ in range(num_block_layers)
+            for layer in range(num_block_layers)
         )
     else:
-        past_key_values = tuple(
-            (
-                torch.empty(batch_size, num_attention_heads, seq_len, num_embedding_size_per_head)
-                .to(model.dtype)
-                .to(model.device),
-                torch.empty(batch_size, num_attention_heads, seq_len, num_embedding_size_per_head)
-                .to(model.dtype)
-                .to(model.device),
-            )
-            for _ in range(num_block_layers)
+        buffer = torch.empty(
+            num_block_layers,
+            2,
+            batch_size,
+            num_attention_heads,
+            seq_len,
+            num_embedding_size_per_head,
+            dtype=model.dtype,
+            device=model.device,
         )
+        past_key_values = tuple((buffer[layer, 0], buffer[layer, 1]) for layer in range(num_block_layers))
     return past_key_values
 
 
@@ -224,15 +216,8 @@ def prepare_jit_inputs(inputs, model, tokenizer):
     dummy_input = dummy_input.to(model.device)
     if model.config.use_cache:
         dummy_input["past_key_values"] = generate_past_key_values(model, batch_size, 1)
-    dummy_input["attention_mask"] = torch.cat(
-        [
-            torch.zeros(dummy_input["attention_mask"].shape[0], 1)
-            .to(dummy_input["attention_mask"].dtype)
-            .to(model.device),
-            dummy_input["attention_mask"],
-        ],
-        -1,
-    )
+    # Prepend a masked position for the (empty) past key values
+    dummy_input["attention_mask"] = torch.nn.functional.pad(dummy_input["attention_mask"], (1, 0), value=0)
     return dummy_input
 
 
@@ -246,21 +231,12 @@ class _ModelFallbackWrapper(GenerationMixin):
     def __call__(self, *args, **kwargs):
         if kwargs["past_key_values"] is None and self._default.config.use_cache:
             kwargs["past_key_values"] = generate_past_key_values(self._default, kwargs["input_ids"].shape[0], 0)
-        kwargs.pop("position_ids", None)
-        for k in list(kwargs.keys()):
-            if kwargs[k] is None or isinstance(kwargs[k], bool):
-                kwargs.pop(k)
+        kwargs = {
+            k: v for k, v in kwargs.items() if k != "position_ids" and v is not None and not isinstance(v, bool)
+        }
         outputs = self._optimized(**kwargs)
-        lm_logits = outputs[0]
-        past_key_values = outputs[1]
-        fixed_output = CausalLMOutputWithPast(
-            loss=None,
-            logits=lm_logits,
-            past_key_values=past_key_values,
-            hidden_states=None,
-            attentions=None,
-        )
-        return fixed_output
+        # `generate` looks `past_key_values` up by key in the outputs, so this has to stay a `ModelOutput`
+        return CausalLMOutputWithPast(logits=outputs[0], past_key_values=outputs[1])
 
     def __getattr__(self, item):
         return getattr(self._default, item)
@@ -332,9 +308,41 @@ def main():
         action="store_true",
         help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
     )
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        default=None,
+        choices=["int8", "int4"],
+        help=(
+            "Load the model weights quantized with bitsandbytes to reduce memory usage and bandwidth (requires a GPU)."
+            " This mostly helps large memory-bound models, small models can get slower."
+        ),
+    )
+    parser.add_argument(
+        "--use_bettertransformer",
+        action="store_true",
+        help=(
+            "Whether or not to convert the model with BetterTransformer (requires `optimum`), so that attention runs"
+            " through PyTorch's `scaled_dot_product_attention` fused kernels (FlashAttention/memory-efficient)"
+        ),
+    )
     parser.add_argument("--jit", action="store_true", help="Whether or not to use jit trace to accelerate inference")
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Whether or not to compile the model forward with `torch.compile` (requires PyTorch >= 2.0)",
+    )
     args = parser.parse_args()
 
+    if args.quantization is not None and args.use_cpu:
+        raise ValueError("`--quantization` can't be used with `--use_cpu`, bitsandbytes requires a GPU.")
+
+    if args.compile:
+        if args.jit:
+            raise ValueError("`--jit` and `--compile` can't be used at the same time.")
+        if not is_torch_compile_available():
+            raise ImportError("Using `--compile` requires PyTorch >= 2.0.")
+
     # Initialize the distributed state.
     distributed_state = PartialState(cpu=args.use_cpu)
 
@@ -346,20 +354,36 @@ def main():
     # Initialize the model and tokenizer
     try:
         args.model_type = args.model_type.lower()
-        model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+        model_class_name, tokenizer_class_name = MODEL_CLASSES[args.model_type]
     except KeyError:
         raise KeyError("the model {} you specified is not supported. You are welcome to add it and open a PR :)")
+    model_class = getattr(transformers, model_class_name)
+    tokenizer_class = getattr(transformers, tokenizer_class_name)
 
     tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
-    model = model_class.from_pretrained(args.model_name_or_path)
 
-    # Set the model to the right device
-    model.to(distributed_state.device)
+    quantization_config = None
+    if args.quantization == "int8":
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+    elif args.quantization == "int4":
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True, bnb_4bit_compute_dtype=torch.float16, bnb_4bit_quant_type="nf4"
+        )
+
+    # Load the weights directly on the right device and in the right precision, instead of moving and casting the
+    # whole model once it is loaded
+    model = model_class.from_pretrained(
+        args.model_name_or_path,
+        device_map=distributed_state.device,
+        torch_dtype=torch.float16 if args.fp16 else None,
+        quantization_config=quantization_config,
+    )
+
+    if args.use_bettertransformer:
+        model = model.to_bettertransformer()
 
-    if args.fp16:
-        model.half()
     max_seq_length = getattr(model.config, "max_position_embeddings", 0)
     args.length = adjust_length_to_model(args.length, max_sequence_length=max_seq_length)
     logger.info(args)
@@ -367,7 +391,7 @@ def main():
     prompt_text = args.prompt if args.prompt else input("Model prompt >>> ")
 
     # Different models need different input formatting and/or extra arguments
-    requires_preprocessing = args.model_type in PREPROCESSING_FUNCTIONS.keys()
+    requires_preprocessing = args.model_type in PREPROCESSING_FUNCTIONS
     if requires_preprocessing:
         prepare_input = PREPROCESSING_FUNCTIONS.get(args.model_type)
         preprocessed_prompt_text = prepare_input(args, model, tokenizer, prompt_text)
@@ -383,7 +407,10 @@ def main():
     else:
         prefix = args.prefix if args.prefix else args.padding_text
         encoded_prompt = tokenizer.encode(prefix + prompt_text, add_special_tokens=False, return_tensors="pt")
-    encoded_prompt = encoded_prompt.to(distributed_state.device)
+    if distributed_state.device.type == "cuda":
+        # Copying from pinned memory lets the transfer run asynchronously
+        encoded_prompt = encoded_prompt.pin_memory()
+    encoded_prompt = encoded_prompt.to(distributed_state.device, non_blocking=True)
 
     if encoded_prompt.size()[-1] == 0:
         input_ids = None
@@ -407,37 +434,45 @@ def main():
 
         model = _ModelFallbackWrapper(traced_model, model)
 
-    output_sequences = model.generate(
-        input_ids=input_ids,
-        max_length=args.length + len(encoded_prompt[0]),
-        temperature=args.temperature,
-        top_k=args.k,
-        top_p=args.p,
-        repetition_penalty=args.repetition_penalty,
-        do_sample=True,
-        num_return_sequences=args.num_return_sequences,
-    )
+    if args.compile:
+        # The past key values grow by one position at each decoding step, so the sequence dimension is compiled as
+        # dynamic instead of recompiling (and re-capturing graphs) for every new length.
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    # Inference tensors can't be modified in-place outside of inference mode, so the squeeze has to happen in there
+    with torch.inference_mode():
+        output_sequences = model.generate(
+            input_ids=input_ids,
+            max_length=args.length + len(encoded_prompt[0]),
+            temperature=args.temperature,
+            top_k=args.k,
+            top_p=args.p,
+            repetition_penalty=args.repetition_penalty,
+            do_sample=True,
+            num_return_sequences=args.num_return_sequences,
+        )
 
-    # Remove the batch dimension when returning multiple sequences
-    if len(output_sequences.shape) > 2:
-        output_sequences.squeeze_()
+        # Remove the batch dimension when returning multiple sequences
+        if len(output_sequences.shape) > 2:
+            output_sequences.squeeze_()
 
     generated_sequences = []
 
-    for generated_sequence_idx, generated_sequence in enumerate(output_sequences):
-        print(f"=== GENERATED SEQUENCE {generated_sequence_idx + 1} ===")
-        generated_sequence = generated_sequence.tolist()
+    # Copy the whole batch to host memory once instead of once per sequence
+    output_ids = output_sequences.tolist()
 
-        # Decode text
-        text = tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
+    # Decode text, the prompt is shared by all the sequences so it only needs to be decoded once
+    texts = tokenizer.batch_decode(output_ids, clean_up_tokenization_spaces=True)
+    prompt_length = len(tokenizer.decode(encoded_prompt[0], clean_up_tokenization_spaces=True))
+
+    for generated_sequence_idx, text in enumerate(texts):
+        print(f"=== GENERATED SEQUENCE {generated_sequence_idx + 1} ===")
 
         # Remove all text after the stop token
         text = text[: text.find(args.stop_token) if args.stop_token else None]
 
         # Add the prompt at the beginning of the sequence. Remove the excess text that was used for pre-processing
-        total_sequence = (
-            prompt_text + text[len(tokenizer.decode(encoded_prompt[0], clean_up_tokenization_spaces=True)) :]
-        )
+        total_sequence = prompt_text + text[prompt_length:]
 
         generated_sequences.append(total_sequence)
         print(total_sequence)